@@ -5,25 +5,43 @@ Python FastAPI service for AI-powered journal analysis using LangChain and Ollam
 
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Tuple
 import sqlite3
-import json
+import orjson
 import os
-import shutil
+import hashlib
+import time
 from datetime import datetime
 import logging
 import re
-from collections import Counter
+from collections import Counter, OrderedDict
+import uuid
+from functools import lru_cache
+from abc import ABC, abstractmethod
+
+import faiss
+import numpy as np
+import torch
+from sentence_transformers import SentenceTransformer
+
+try:
+    from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+    from optimum.onnxruntime.configuration import AutoQuantizationConfig
+    from transformers import AutoTokenizer
+except ImportError:
+    ORTModelForFeatureExtraction = None
 
 # LangChain imports
 from langchain_ollama import OllamaLLM
 from langchain_community.vectorstores import Chroma
-from langchain_community.embeddings import SentenceTransformerEmbeddings
+from langchain.embeddings.base import Embeddings
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain.chains import RetrievalQA
 from langchain.prompts import PromptTemplate
-from langchain.schema import Document
+from langchain.schema import BaseRetriever, Document
+from langchain.callbacks.manager import CallbackManagerForRetrieverRun
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -34,21 +52,68 @@ app = FastAPI(title="Journal RAG Service", version="1.0.0")
 # CORS middleware for Tauri frontend
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],  # In production, specify exact origins
+    allow_origins=["http://localhost:5173", "tauri://localhost", "https://tauri.localhost"],  # Vite dev server and Tauri
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
 )
 
 # Global variables for RAG components
+DB_CONN: Optional[sqlite3.Connection] = None
 llm = None
 vectorstore = None
 embeddings = None
 qa_chain = None
+retriever = None
 entry_metadata_map: Dict[str, Dict[str, Any]] = {}
-user_profile: Dict[str, Any] = {"name": None, "name_sources": []}
+semantic_caches: Dict[str, "SemanticCache"] = {}
+entry_profile_mentions: Dict[str, Tuple[str, Counter, Counter]] = {}
+NAME_PATTERN = re.compile(r"\bMy name is\s+([A-Z][a-z]+)\b", re.IGNORECASE)
+_MONTH = r"(?:jan(?:uary)?|feb(?:ruary)?|mar(?:ch)?|apr(?:il)?|may|june?|july?|aug(?:ust)?|sep(?:t(?:ember)?)?|oct(?:ober)?|nov(?:ember)?|dec(?:ember)?)"
+_DAY = r"\d{1,2}(?:st|nd|rd|th)?"
+# Only date-like captures: "March 5th", "5th of March, 1990", "2024-03-05", "03/05"
+BIRTHDAY_PATTERN = re.compile(
+    rf"\bMy birthday is\s+(?:on\s+)?((?:{_MONTH}\.?\s+{_DAY}|{_DAY}\s+(?:of\s+)?{_MONTH})(?:,?\s+\d{{4}})?"
+    rf"|\d{{4}}-\d{{2}}-\d{{2}}|\d{{1,2}}[/-]\d{{1,2}}(?:[/-]\d{{2,4}})?)\b",
+    re.IGNORECASE,
+)
+user_profile: Dict[str, Any] = {
+    "name": None,
+    "name_sources": [],
+    "birthdays": {},     # user_id -> (birthday, number of mentions)
+    "mood_counts": {},   # user_id -> Counter of moods
+    "entry_counts": {},  # user_id -> number of entries
+}
 PERSIST_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "chroma_db"))
 COLLECTION_NAME = "journal_entries"
+INDEX_STATE_PATH = os.path.join(PERSIST_DIR, "embedded_entries.db")
+EMBED_MODEL_NAME = "all-MiniLM-L6-v2"
+EMBED_BATCH_SIZE = 64
+EMBEDDINGS_BACKEND = os.getenv("EMBEDDINGS_BACKEND", "onnx")
+ONNX_MODEL_ID = "sentence-transformers/all-MiniLM-L6-v2"
+ONNX_MODEL_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "onnx_models", "all-MiniLM-L6-v2-int8"))
+ONNX_MODEL_FILE = "model_quantized.onnx"
+ONNX_MAX_SEQ_LENGTH = 256
+QUERY_EMBED_CACHE_SIZE = 1024
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95"))
+SEMANTIC_CACHE_SIZE = int(os.getenv("SEMANTIC_CACHE_SIZE", "512"))
+INDEXING_MESSAGE = "I'm still indexing your journal entries. Please try again in a moment."
+
+QA_PROMPT = PromptTemplate(
+    template="""You are a thoughtful journaling companion.
+Use the journal context to answer the user. Adjust your tone and length to the question:
+- For direct facts (e.g. "What is my name?"), respond in one or two concise sentences.
+- For reflective or open-ended questions (e.g. "What patterns do you notice?"), be more expansive, weaving themes with empathy.
+- If context is missing, say so gently and offer next steps.
+
+Context:
+{context}
+
+Question: {question}
+
+Answer:""",
+    input_variables=["context", "question"]
+)
 
 # Pydantic models
 class JournalEntry(BaseModel):
@@ -71,6 +136,188 @@ class ChatResponse(BaseModel):
     sources: List[Dict[str, Any]]
     conversation_id: str
 
+def normalize_query(text: str) -> str:
+    """Lowercase and collapse whitespace so equivalent questions share a cache key"""
+    return " ".join(text.lower().split())
+
+class BatchedEmbeddings(Embeddings, ABC):
+    """Base for MiniLM embedders: length-sorted batching and a cached query path"""
+
+    dimension: int
+    model_id: str  # identifies the vector space; persisted with the index
+
+    def __init__(self, batch_size: int = EMBED_BATCH_SIZE):
+        self.batch_size = batch_size
+        self._cached_query = lru_cache(maxsize=QUERY_EMBED_CACHE_SIZE)(self._encode_query)
+
+    @abstractmethod
+    def _tokenize(self, texts: List[str]) -> Tuple[List[int], Any]:
+        """Return token counts for sorting plus any tokenizer output worth reusing"""
+
+    @abstractmethod
+    def _encode_batch(self, texts: List[str], features: Any, idx: np.ndarray) -> np.ndarray:
+        """Encode texts[idx] into unit vectors; implemented by each backend"""
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        """Encode texts into an (N, dim) float32 matrix of unit vectors"""
+        if not texts:
+            return np.empty((0, self.dimension), dtype=np.float32)
+
+        # Smart batching: sort by token count so each batch pads to a similar
+        # length, and scatter each batch back to the caller's order.
+        lengths, features = self._tokenize(texts)
+        order = np.argsort(lengths, kind="stable")
+        embs = np.empty((len(texts), self.dimension), dtype=np.float32)
+        for start in range(0, len(order), self.batch_size):
+            idx = order[start:start + self.batch_size]
+            embs[idx] = self._encode_batch(texts, features, idx)
+        return embs
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.encode(texts).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return list(self._cached_query(normalize_query(text)))
+
+    def _encode_query(self, normalized: str) -> Tuple[float, ...]:
+        return tuple(self.encode([normalized])[0].tolist())
+
+class BatchedSentenceTransformerEmbeddings(BatchedEmbeddings):
+    """SentenceTransformer (PyTorch) backend"""
+
+    def __init__(self, model_name: str = EMBED_MODEL_NAME, batch_size: int = EMBED_BATCH_SIZE):
+        super().__init__(batch_size)
+        self.model = SentenceTransformer(model_name)
+        self.dimension = self.model.get_sentence_embedding_dimension()
+        self.model_id = f"sentence-transformers:{model_name}"
+
+    def _tokenize(self, texts: List[str]) -> Tuple[List[int], Any]:
+        input_ids = self.model.tokenizer(texts, truncation=True, max_length=self.model.max_seq_length)["input_ids"]
+        return [len(ids) for ids in input_ids], None
+
+    def _encode_batch(self, texts: List[str], features: Any, idx: np.ndarray) -> np.ndarray:
+        # One encode call per batch so SentenceTransformer keeps our grouping
+        with torch.inference_mode():
+            return self.model.encode(
+                [texts[i] for i in idx],
+                batch_size=len(idx),
+                convert_to_numpy=True,
+                normalize_embeddings=True,
+                show_progress_bar=False,
+            )
+
+class OnnxMiniLMEmbeddings(BatchedEmbeddings):
+    """ONNX Runtime backend running an int8 dynamically quantized MiniLM"""
+
+    def __init__(self, model_dir: str = ONNX_MODEL_DIR, batch_size: int = EMBED_BATCH_SIZE):
+        super().__init__(batch_size)
+        if not os.path.exists(os.path.join(model_dir, ONNX_MODEL_FILE)):
+            export_quantized_minilm(model_dir)
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        self.model = ORTModelForFeatureExtraction.from_pretrained(
+            model_dir, file_name=ONNX_MODEL_FILE, provider="CPUExecutionProvider"
+        )
+        self.dimension = self.model.config.hidden_size
+        self.model_id = f"onnx-int8:{os.path.basename(os.path.normpath(model_dir))}/{ONNX_MODEL_FILE}"
+
+    def _tokenize(self, texts: List[str]) -> Tuple[List[int], Any]:
+        # Tokenize once without padding; each batch is padded to its own longest sequence
+        features = self.tokenizer(texts, truncation=True, max_length=ONNX_MAX_SEQ_LENGTH)
+        return [len(ids) for ids in features["input_ids"]], features
+
+    def _encode_batch(self, texts: List[str], features: Any, idx: np.ndarray) -> np.ndarray:
+        inputs = self.tokenizer.pad(
+            {key: [values[i] for i in idx] for key, values in features.items()},
+            return_tensors="np",
+        )
+        hidden = np.asarray(self.model(**inputs).last_hidden_state, dtype=np.float32)
+
+        # Mean-pool over real tokens, then L2-normalize
+        mask = inputs["attention_mask"][..., None].astype(np.float32)
+        pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        pooled /= np.linalg.norm(pooled, axis=1, keepdims=True) + 1e-12
+        return pooled
+
+def export_quantized_minilm(model_dir: str):
+    """Export MiniLM to ONNX once and save an int8 dynamically quantized copy"""
+    logger.info(f"Exporting {ONNX_MODEL_ID} to ONNX (int8) at {model_dir}...")
+    os.makedirs(model_dir, exist_ok=True)
+    model = ORTModelForFeatureExtraction.from_pretrained(
+        ONNX_MODEL_ID, export=True, provider="CPUExecutionProvider"
+    )
+    model.save_pretrained(model_dir)
+    AutoTokenizer.from_pretrained(ONNX_MODEL_ID).save_pretrained(model_dir)
+
+    quantizer = ORTQuantizer.from_pretrained(model_dir)
+    quantizer.quantize(
+        save_dir=model_dir,
+        quantization_config=AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=True),
+    )
+
+class FlatIPRetriever(BaseRetriever):
+    """Exact inner-product search over an in-memory FAISS index of unit vectors"""
+
+    index: Any
+    documents: List[Document]
+    embeddings: Any
+    k: int = 5
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        if not self.documents:
+            return []
+        q = np.asarray([self.embeddings.embed_query(query)], dtype=np.float32)
+        _, indices = self.index.search(q, min(self.k, len(self.documents)))
+        return [self.documents[i] for i in indices[0] if i >= 0]
+
+class SemanticCache:
+    """LRU cache of chat responses looked up by query embedding similarity"""
+
+    def __init__(self, dim: int, threshold: float = SEMANTIC_CACHE_THRESHOLD, max_entries: int = SEMANTIC_CACHE_SIZE):
+        self.index = faiss.IndexIDMap2(faiss.IndexFlatIP(dim))
+        self.responses: "OrderedDict[int, ChatResponse]" = OrderedDict()
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self._next_id = 0
+
+    def lookup(self, q_emb: np.ndarray) -> Optional[ChatResponse]:
+        if not self.responses:
+            return None
+        scores, ids = self.index.search(q_emb.reshape(1, -1), 1)
+        key = int(ids[0][0])
+        if key < 0 or scores[0][0] < self.threshold:
+            return None
+        self.responses.move_to_end(key)
+        return self.responses[key]
+
+    def add(self, q_emb: np.ndarray, response: ChatResponse):
+        key = self._next_id
+        self._next_id += 1
+        self.index.add_with_ids(q_emb.reshape(1, -1), np.array([key], dtype=np.int64))
+        self.responses[key] = response
+        if len(self.responses) > self.max_entries:
+            evicted, _ = self.responses.popitem(last=False)
+            self.index.remove_ids(np.array([evicted], dtype=np.int64))
+
+def build_flat_retriever(store: Chroma, k: int = 5) -> FlatIPRetriever:
+    """Load every stored chunk vector into a contiguous FAISS IndexFlatIP"""
+    data = store._collection.get(include=["embeddings", "documents", "metadatas"])
+    dim = embeddings.dimension
+    embs = np.ascontiguousarray(data["embeddings"] or np.empty((0, dim)), dtype=np.float32).reshape(-1, dim)
+    embs /= np.linalg.norm(embs, axis=1, keepdims=True) + 1e-12
+
+    index = faiss.IndexFlatIP(dim)
+    index.add(embs)
+    documents = [
+        Document(page_content=text, metadata=metadata or {})
+        for text, metadata in zip(data["documents"], data["metadatas"])
+    ]
+    return FlatIPRetriever(index=index, documents=documents, embeddings=embeddings, k=k)
+
 def get_database_path() -> str:
     torch_app_path = os.path.expanduser(
         "~/Library/Application Support/com.tauri.dev/journal.db"
@@ -85,10 +332,42 @@ def get_database_path() -> str:
 
     return "./journal.db"
 
-def get_db_connection():
-    """Get SQLite database connection"""
-    db_path = get_database_path()
-    return sqlite3.connect(db_path)
+def get_db_connection() -> sqlite3.Connection:
+    """Get the shared SQLite connection, opening it on first use"""
+    global DB_CONN
+    if DB_CONN is None:
+        DB_CONN = sqlite3.connect(get_database_path(), check_same_thread=False, isolation_level=None)
+        DB_CONN.row_factory = sqlite3.Row
+        DB_CONN.executescript("""
+            PRAGMA mmap_size = 268435456;
+            PRAGMA cache_size = -65536;
+            PRAGMA journal_mode = WAL;
+        """)
+    return DB_CONN
+
+def open_index_state() -> sqlite3.Connection:
+    """Open the table tracking which entry versions are embedded in the vector store"""
+    conn = sqlite3.connect(INDEX_STATE_PATH)
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS embedded_entries(
+            id TEXT PRIMARY KEY,
+            hash TEXT NOT NULL,
+            updated_at TEXT
+        );
+        CREATE TABLE IF NOT EXISTS index_meta(
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+    """)
+    return conn
+
+def entry_content_hash(entry: JournalEntry) -> str:
+    """Hash every field that ends up in an entry's embedded document"""
+    digest = hashlib.blake2b(digest_size=16)
+    for part in (entry.title, entry.body, entry.created_at, entry.mood or "", ",".join(entry.tags or [])):
+        digest.update((part or "").encode("utf-8"))
+        digest.update(b"\x00")
+    return digest.hexdigest()
 
 def init_rag_components():
     """Initialize LangChain RAG components"""
@@ -100,29 +379,77 @@ def init_rag_components():
         llm = OllamaLLM(model="llama3.1:8b", base_url="http://localhost:11434")
         logger.info("✅ Ollama LLM initialized")
         
-        embeddings = SentenceTransformerEmbeddings(model_name="all-MiniLM-L6-v2")
-        logger.info("✅ Embeddings initialized")
+        # Uvicorn workers often default to a single intra-op thread
+        torch.set_num_threads(os.cpu_count() or 4)
+        try:
+            torch.set_num_interop_threads(2)
+        except RuntimeError:
+            # Can only be set before the first parallel op runs
+            pass
+
+        embeddings = None
+        if EMBEDDINGS_BACKEND == "onnx":
+            if ORTModelForFeatureExtraction is None:
+                logger.warning("optimum[onnxruntime] is not installed; using SentenceTransformer embeddings")
+            else:
+                try:
+                    embeddings = OnnxMiniLMEmbeddings()
+                    logger.info("✅ Embeddings initialized (ONNX Runtime, int8)")
+                except Exception as e:
+                    # A failed ONNX export/quantization shouldn't take the service down
+                    logger.warning(f"ONNX embeddings unavailable ({e}); using SentenceTransformer embeddings")
+        if embeddings is None:
+            embeddings = BatchedSentenceTransformerEmbeddings()
+            if torch.cuda.is_available():
+                embeddings.model.to("cuda").half()
+            else:
+                torch.set_float32_matmul_precision("medium")
+            logger.info(f"✅ Embeddings initialized on {embeddings.model.device}")
         
     except Exception as e:
         logger.error(f"❌ Error initializing RAG components: {e}")
         raise
 
+def scan_profile_mentions(text: str, names: Counter, birthdays: Counter):
+    names.update(name.title() for name in NAME_PATTERN.findall(text))
+    birthdays.update(day.strip() for day in BIRTHDAY_PATTERN.findall(text))
+
 def extract_user_insights(entries: List[JournalEntry]):
-    """Extract simple user profile insights such as name occurrences"""
-    global user_profile
+    """Extract simple user profile insights such as name occurrences and mood counts"""
+    global user_profile, entry_profile_mentions
 
-    content_texts = []
+    # Only rescan entries that are new or were updated since the last refresh
+    counter = Counter()
+    birthday_counters: Dict[str, Counter] = {}
+    scanned = {}
     for entry in entries:
-        content_texts.append(entry.body)
-        if entry.title:
-            content_texts.append(entry.title)
-
-    combined_text = "\n".join(content_texts)
-    name_pattern = re.compile(r"\bMy name is\s+([A-Z][a-z]+)\b", re.IGNORECASE)
-    matches = name_pattern.findall(combined_text)
+        cached = entry_profile_mentions.get(entry.id)
+        if cached and cached[0] == entry.updated_at:
+            _, mentions, birthdays = cached
+        else:
+            mentions, birthdays = Counter(), Counter()
+            scan_profile_mentions(entry.body, mentions, birthdays)
+            if entry.title:
+                scan_profile_mentions(entry.title, mentions, birthdays)
+        scanned[entry.id] = (entry.updated_at, mentions, birthdays)
+        counter.update(mentions)
+        if birthdays:
+            birthday_counters.setdefault(entry.user_id, Counter()).update(birthdays)
+    entry_profile_mentions = scanned
+
+    entry_counts: Counter = Counter()
+    mood_counts: Dict[str, Counter] = {}
+    for entry in entries:
+        entry_counts[entry.user_id] += 1
+        if entry.mood:
+            mood_counts.setdefault(entry.user_id, Counter())[entry.mood.lower()] += 1
+    user_profile["entry_counts"] = dict(entry_counts)
+    user_profile["mood_counts"] = mood_counts
+    user_profile["birthdays"] = {
+        user_id: birthdays.most_common(1)[0] for user_id, birthdays in birthday_counters.items()
+    }
 
-    if matches:
-        counter = Counter(name.title() for name in matches)
+    if counter:
         most_common = counter.most_common(1)[0]
         user_profile["name"] = most_common[0]
         user_profile["name_sources"] = [f"Mentioned {most_common[1]} time(s) in journal entries"]
@@ -138,22 +465,12 @@ def load_journal_entries_to_vectorstore():
     try:
         logger.info("Loading journal entries into vector store...")
         
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
         # Get all journal entries
-        cursor.execute("""
+        rows = get_db_connection().execute("""
             SELECT id, user_id, title, body, created_at, updated_at, mood, tags
             FROM entries 
             ORDER BY created_at DESC
-        """)
-        
-        rows = cursor.fetchall()
-        conn.close()
-        
-        if not rows:
-            logger.info("📝 No journal entries found")
-            return
+        """).fetchall()
         
         # Convert to documents
         documents = []
@@ -163,7 +480,7 @@ def load_journal_entries_to_vectorstore():
 
         for row in rows:
             entry_id, user_id, title, body, created_at, updated_at, mood, tags = row
-            tags_list = json.loads(tags) if tags else []
+            tags_list = orjson.loads(tags) if tags else []
 
             entries.append(
                 JournalEntry(
@@ -203,52 +520,95 @@ def load_journal_entries_to_vectorstore():
 
         extract_user_insights(entries)
         
+        # Reuse the persisted vector store and only re-embed entries whose
+        # content changed since the last refresh
+        global vectorstore, qa_chain, retriever
+        os.makedirs(PERSIST_DIR, exist_ok=True)
+        vectorstore = Chroma(
+            collection_name=COLLECTION_NAME,
+            embedding_function=embeddings,
+            persist_directory=PERSIST_DIR,
+        )
+
+        state = open_index_state()
+        indexed_hashes = dict(state.execute("SELECT id, hash FROM embedded_entries"))
+        row = state.execute("SELECT value FROM index_meta WHERE key = 'embed_model'").fetchone()
+        indexed_model = row[0] if row else None
+        if vectorstore._collection.count() and (not indexed_hashes or indexed_model != embeddings.model_id):
+            # Store was built before index state was tracked, or by a different embedding
+            # model (e.g. EMBEDDINGS_BACKEND changed or optimum is missing); start it over
+            logger.info(f"Rebuilding vector store for {embeddings.model_id} (was {indexed_model})")
+            vectorstore.delete_collection()
+            vectorstore = Chroma(
+                collection_name=COLLECTION_NAME,
+                embedding_function=embeddings,
+                persist_directory=PERSIST_DIR,
+            )
+            state.execute("DELETE FROM embedded_entries")
+            indexed_hashes = {}
+        current_hashes = {entry.id: entry_content_hash(entry) for entry in entries}
+
+        stale_ids = [eid for eid, h in indexed_hashes.items() if current_hashes.get(eid) != h]
+        pending_ids = {eid for eid, h in current_hashes.items() if indexed_hashes.get(eid) != h}
+
+        # Pending entries are cleared too: a refresh that died after adding their chunks but
+        # before committing the state would otherwise leave duplicates next to the re-adds
+        to_delete = sorted(set(stale_ids) | pending_ids)
+        if to_delete:
+            vectorstore._collection.delete(where={"id": {"$in": to_delete}})
+
         # Split documents
         text_splitter = RecursiveCharacterTextSplitter(
             chunk_size=1000,
             chunk_overlap=200
         )
-        split_docs = text_splitter.split_documents(documents)
-        
-        # Recreate vector store from scratch
-        global vectorstore, qa_chain
-        if os.path.exists(PERSIST_DIR):
-            shutil.rmtree(PERSIST_DIR)
-
-        os.makedirs(PERSIST_DIR, exist_ok=True)
-        vectorstore = Chroma.from_documents(
-            documents=split_docs,
-            embedding=embeddings,
-            collection_name=COLLECTION_NAME,
-            persist_directory=PERSIST_DIR,
+        split_docs = text_splitter.split_documents(
+            [doc for doc in documents if doc.metadata["id"] in pending_ids]
         )
-        vectorstore.persist()
-        
-        prompt_template = """You are a thoughtful journaling companion.
-Use the journal context to answer the user. Adjust your tone and length to the question:
-- For direct facts (e.g. "What is my name?"), respond in one or two concise sentences.
-- For reflective or open-ended questions (e.g. "What patterns do you notice?"), be more expansive, weaving themes with empathy.
-- If context is missing, say so gently and offer next steps.
 
-Context:
-{context}
-
-Question: {question}
+        # Embed all new chunks in one batched pass and hand the vectors straight
+        # to the collection instead of letting Chroma encode them one by one.
+        if split_docs:
+            texts = [doc.page_content for doc in split_docs]
+            vectors = embeddings.encode(texts)
+            vectorstore._collection.add(
+                ids=[str(uuid.uuid4()) for _ in split_docs],
+                embeddings=vectors.tolist(),
+                documents=texts,
+                metadatas=[doc.metadata for doc in split_docs],
+            )
+        vectorstore.persist()
 
-Answer:"""
+        state.executemany("DELETE FROM embedded_entries WHERE id = ?", [(eid,) for eid in stale_ids])
+        state.executemany(
+            "INSERT OR REPLACE INTO embedded_entries(id, hash, updated_at) VALUES(?, ?, ?)",
+            [(entry.id, current_hashes[entry.id], entry.updated_at) for entry in entries if entry.id in pending_ids],
+        )
+        state.execute(
+            "INSERT OR REPLACE INTO index_meta(key, value) VALUES('embed_model', ?)", (embeddings.model_id,)
+        )
+        state.commit()
+        state.close()
 
-        PROMPT = PromptTemplate(
-            template=prompt_template,
-            input_variables=["context", "question"]
+        logger.info(
+            f"Vector store refresh: {len(pending_ids)} entries embedded, "
+            f"{len(set(stale_ids) - pending_ids)} removed"
         )
+
+        if not entries:
+            logger.info("📝 No journal entries found")
+            return
         
+        retriever = build_flat_retriever(vectorstore, k=5)
         qa_chain = RetrievalQA.from_chain_type(
             llm=llm,
             chain_type="stuff",
-            retriever=vectorstore.as_retriever(search_kwargs={"k": 5}),
-            chain_type_kwargs={"prompt": PROMPT},
+            retriever=retriever,
+            chain_type_kwargs={"prompt": QA_PROMPT},
             return_source_documents=True
         )
+        # Cached answers may no longer reflect the refreshed entries
+        semantic_caches.clear()
         
         logger.info(f"✅ Loaded {len(entries)} journal entries into vector store")
         
@@ -261,40 +621,44 @@ Answer:"""
 async def startup_event():
     """Initialize RAG components on startup"""
     try:
+        get_db_connection()
         init_rag_components()
         load_journal_entries_to_vectorstore()
         logger.info("🚀 RAG service started successfully")
     except Exception as e:
         logger.error(f"❌ Failed to start RAG service: {e}")
 
-@app.get("/health")
-async def health_check():
-    """Health check endpoint"""
+HEALTH_TEMPLATE = {"status": "healthy", "service": "journal-rag"}
+
+@lru_cache(maxsize=1)
+def health_payload(second: int) -> Dict[str, Any]:
+    """Health payload, rebuilt at most once per monotonic second"""
     return {
-        "status": "healthy", 
-        "service": "journal-rag",
+        **HEALTH_TEMPLATE,
         "llm_ready": llm is not None,
         "vectorstore_ready": vectorstore is not None,
         "timestamp": datetime.now().isoformat()
     }
 
+@app.get("/health")
+async def health_check():
+    """Health check endpoint"""
+    return health_payload(int(time.monotonic()))
+
 @app.get("/entries/{user_id}")
 async def get_entries(user_id: str):
     """Get all journal entries for a user"""
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute("""
+        rows = get_db_connection().execute("""
             SELECT id, user_id, title, body, created_at, updated_at, mood, tags
             FROM entries 
             WHERE user_id = ? 
             ORDER BY created_at DESC
-        """, (user_id,))
+        """, (user_id,)).fetchall()
         
         entries = []
-        for row in cursor.fetchall():
-            tags = json.loads(row[7]) if row[7] else []
+        for row in rows:
+            tags = orjson.loads(row[7]) if row[7] else []
             entries.append(JournalEntry(
                 id=row[0],
                 user_id=row[1], 
@@ -306,79 +670,192 @@ async def get_entries(user_id: str):
                 tags=tags
             ))
         
-        conn.close()
         return {"entries": entries}
         
     except Exception as e:
         logger.error(f"Error fetching entries: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+def answer_name(request: ChatRequest) -> ChatResponse:
+    if user_profile.get("name"):
+        answer = (
+            f"Based on your journal entries, your name appears to be {user_profile['name']}."
+        )
+        return ChatResponse(
+            answer=answer,
+            sources=[{"title": note} for note in user_profile.get("name_sources", [])],
+            conversation_id=request.conversation_id or "default",
+        )
+    return ChatResponse(
+        answer="I didn't find an explicit mention of your name in the journal entries. Feel free to tell me how you'd like to be addressed!",
+        sources=[],
+        conversation_id=request.conversation_id or "default",
+    )
+
+def answer_birthday(request: ChatRequest) -> ChatResponse:
+    birthday = user_profile["birthdays"].get(request.user_id)
+    if birthday:
+        return ChatResponse(
+            answer=f"Based on your journal entries, your birthday is {birthday[0]}.",
+            sources=[{"title": f"Mentioned {birthday[1]} time(s) in journal entries"}],
+            conversation_id=request.conversation_id or "default",
+        )
+    return ChatResponse(
+        answer="I didn't find your birthday mentioned in the journal entries. Let me know and I'll remember it once you write it down!",
+        sources=[],
+        conversation_id=request.conversation_id or "default",
+    )
+
+def answer_common_mood(request: ChatRequest) -> ChatResponse:
+    mood_counts = user_profile["mood_counts"].get(request.user_id)
+    if mood_counts:
+        mood, count = mood_counts.most_common(1)[0]
+        answer = (
+            f"Your most common mood is {mood}, recorded in {count} of your "
+            f"{user_profile['entry_counts'].get(request.user_id, 0)} journal entries."
+        )
+    else:
+        answer = "None of your journal entries have a mood recorded yet."
+    return ChatResponse(answer=answer, sources=[], conversation_id=request.conversation_id or "default")
+
+def answer_entry_count(request: ChatRequest) -> ChatResponse:
+    count = user_profile["entry_counts"].get(request.user_id, 0)
+    return ChatResponse(
+        answer=f"You have written {count} journal {'entry' if count == 1 else 'entries'}.",
+        sources=[],
+        conversation_id=request.conversation_id or "default",
+    )
+
+# Factual questions answered from precomputed profile data, skipping retrieval and the LLM.
+# The name question may be wrapped in filler ("hey, what is my name ?"); the others are
+# anchored to the whole question so e.g. "how many entries mention my sister?" still goes
+# through RAG.
+DIRECT_ANSWERS = (
+    (re.compile(r"\bwhat(\s+is|'s)\s+my\s+name\b"), answer_name),
+    (re.compile(r"^(when|what)(\s+is|'s)\s+my\s+birthday\s*[?.!]*$"), answer_birthday),
+    (re.compile(r"^what(\s+is|'s)\s+my\s+(most\s+common|usual|typical|most\s+frequent)\s+mood\s*[?.!]*$"), answer_common_mood),
+    (re.compile(r"^how\s+many\s+(journal\s+)?entries\s+(do\s+i\s+have|have\s+i\s+(written|made))(\s+so\s+far)?\s*[?.!]*$"), answer_entry_count),
+)
+
+def answer_directly(request: ChatRequest) -> Optional[ChatResponse]:
+    """Answer known factual questions from the user profile, if one matches"""
+    normalized_question = request.message.strip().lower()
+    for pattern, handler in DIRECT_ANSWERS:
+        if pattern.search(normalized_question):
+            return handler(request)
+    return None
+
+def lookup_semantic_cache(request: ChatRequest) -> Tuple[SemanticCache, np.ndarray, Optional[ChatResponse]]:
+    """Return the user's cache, the query embedding and any cached response"""
+    q_emb = np.asarray(embeddings.embed_query(request.message), dtype=np.float32)
+    cache = semantic_caches.get(request.user_id)
+    if cache is None:
+        cache = semantic_caches[request.user_id] = SemanticCache(q_emb.shape[0])
+    cached = cache.lookup(q_emb)
+    if cached is not None:
+        logger.info("Answered from semantic cache")
+        cached = cached.model_copy(update={"conversation_id": request.conversation_id or "default"})
+    return cache, q_emb, cached
+
+def sources_from_documents(docs: List[Document]) -> List[Dict[str, Any]]:
+    """Extract sources, one per entry"""
+    unique = {}
+    for doc in docs:
+        key = doc.metadata.get("id") or doc.metadata.get("title")
+        if key in unique:
+            continue
+        unique[key] = {
+            "title": doc.metadata.get("title", "Unknown"),
+            "date": doc.metadata.get("created_at", "Unknown"),
+            "mood": doc.metadata.get("mood", None),
+            "tags": doc.metadata.get("tags", [])
+        }
+    return list(unique.values())
+
 @app.post("/chat")
 async def chat_with_ai(request: ChatRequest):
     """Chat with AI using RAG"""
     try:
         if not qa_chain:
             return ChatResponse(
-                answer="I'm still indexing your journal entries. Please try again in a moment.",
+                answer=INDEXING_MESSAGE,
                 sources=[],
                 conversation_id=request.conversation_id or "default"
             )
         
         logger.info(f"Processing chat request: {request.message[:50]}...")
         
-        normalized_question = request.message.strip().lower()
-        if re.search(r"what\s+is\s+my\s+name", normalized_question):
-            if user_profile.get("name"):
-                answer = (
-                    f"Based on your journal entries, your name appears to be {user_profile['name']}."
-                )
-                return ChatResponse(
-                    answer=answer,
-                    sources=[{"title": note} for note in user_profile.get("name_sources", [])],
-                    conversation_id=request.conversation_id or "default",
-                )
-            else:
-                return ChatResponse(
-                    answer="I didn't find an explicit mention of your name in the journal entries. Feel free to tell me how you'd like to be addressed!",
-                    sources=[],
-                    conversation_id=request.conversation_id or "default",
-                )
+        direct = answer_directly(request)
+        if direct is not None:
+            return direct
+
+        cache, q_emb, cached = lookup_semantic_cache(request)
+        if cached is not None:
+            return cached
 
         # Get response from QA chain
         result = qa_chain.invoke({"query": request.message})
-        
-        # Extract sources
-        sources = []
-        if "source_documents" in result:
-            for doc in result["source_documents"]:
-                source_info = {
-                    "title": doc.metadata.get("title", "Unknown"),
-                    "date": doc.metadata.get("created_at", "Unknown"),
-                    "mood": doc.metadata.get("mood", None),
-                    "tags": doc.metadata.get("tags", [])
-                }
-                sources.append(source_info)
-        
-        # Remove duplicate sources
-        unique_sources = []
-        seen_titles = set()
-        for source in sources:
-            if source["title"] not in seen_titles:
-                unique_sources.append(source)
-                seen_titles.add(source["title"])
+        unique_sources = sources_from_documents(result.get("source_documents", []))
         
         logger.info(f"Generated response with {len(unique_sources)} sources")
         
-        return ChatResponse(
+        response = ChatResponse(
             answer=result["result"],
             sources=unique_sources,
             conversation_id=request.conversation_id or "default"
         )
+        cache.add(q_emb, response)
+        return response
         
     except Exception as e:
         logger.error(f"Error in chat: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+def sse_escape(text: str) -> str:
+    # Escape newlines for SSE format
+    return text.replace("\n", "\\n").replace("\r", "\\r")
+
+@app.post("/chat/stream")
+async def chat_stream(request: ChatRequest):
+    """Chat with AI using RAG, streaming the answer as Server-Sent Events"""
+    conversation_id = request.conversation_id or "default"
+
+    async def gen():
+        try:
+            if not qa_chain:
+                ready = ChatResponse(answer=INDEXING_MESSAGE, sources=[], conversation_id=conversation_id)
+            else:
+                ready = answer_directly(request)
+            if ready is None:
+                cache, q_emb, ready = lookup_semantic_cache(request)
+
+            if ready is not None:
+                yield "event: sources\ndata:" + orjson.dumps(ready.sources).decode() + "\n\n"
+                yield "data:" + sse_escape(ready.answer) + "\n\n"
+                yield "event: done\ndata: [DONE]\n\n"
+                return
+
+            docs = await retriever.ainvoke(request.message)
+            sources = sources_from_documents(docs)
+            yield "event: sources\ndata:" + orjson.dumps(sources).decode() + "\n\n"
+
+            prompt = QA_PROMPT.format(
+                context="\n\n".join(doc.page_content for doc in docs),
+                question=request.message,
+            )
+            tokens = []
+            async for tok in llm.astream(prompt):
+                tokens.append(tok)
+                yield "data:" + sse_escape(tok) + "\n\n"
+
+            cache.add(q_emb, ChatResponse(answer="".join(tokens), sources=sources, conversation_id=conversation_id))
+            yield "event: done\ndata: [DONE]\n\n"
+        except Exception as stream_error:
+            logger.error(f"Error in chat stream: {stream_error}")
+            yield "event: error\ndata:" + orjson.dumps({"error": str(stream_error)}).decode() + "\n\n"
+
+    return StreamingResponse(gen(), media_type="text/event-stream")
+
 @app.post("/refresh")
 async def refresh_vectorstore():
     """Refresh the vector store with latest journal entries"""
@@ -1,9 +1,18 @@
 # sidecar/db.py
 import sqlite3
+import json
+import os
+import hashlib
+import logging
+import mmap
+import threading
 from pathlib import Path
 from typing import Iterable, List, Tuple, Optional
-import struct
 from dataclasses import dataclass
+from contextlib import contextmanager
+import numpy as np
+
+logger = logging.getLogger(__name__)
 
 @dataclass
 class Chunk:
@@ -12,6 +21,7 @@ class Chunk:
     text: str
     date: str
     tags: Optional[str]
+    score: float = 0.0  # -bm25, higher is better
 
 def open_db(path: str) -> sqlite3.Connection:
     Path(path).parent.mkdir(parents=True, exist_ok=True)
@@ -58,6 +68,65 @@ def migrate(conn: sqlite3.Connection):
     """)
     conn.commit()
 
+# Every threadpool worker shares one connection, so its transaction is shared too:
+# writers are serialized here, and only re-entry on the same thread joins an open one.
+_write_lock = threading.RLock()
+_tx_state = threading.local()
+
+@contextmanager
+def transaction(conn: sqlite3.Connection):
+    # Group writes into one BEGIN IMMEDIATE ... COMMIT
+    with _write_lock:
+        if getattr(_tx_state, "depth", 0):
+            _tx_state.depth += 1
+            try:
+                yield conn
+            finally:
+                _tx_state.depth -= 1
+            return
+        conn.execute("BEGIN IMMEDIATE")
+        _tx_state.depth = 1
+        try:
+            yield conn
+        except BaseException:
+            conn.rollback()
+            raise
+        else:
+            conn.commit()
+        finally:
+            _tx_state.depth = 0
+
+@contextmanager
+def committed_read(conn: sqlite3.Connection):
+    # Reads on the shared connection would see another thread's open transaction; wait it out
+    with _write_lock:
+        yield conn
+
+@contextmanager
+def bulk_load(conn: sqlite3.Connection):
+    # Trade fsyncs for speed during a full rebuild, then put back whatever was set before.
+    # The WAL journal stays on so a failed rebuild can still roll back.
+    with _write_lock:
+        conn.commit()
+        saved = {p: conn.execute(f"PRAGMA {p}").fetchone()[0]
+                 for p in ("synchronous", "foreign_keys", "temp_store", "cache_size")}
+        conn.executescript("""
+            PRAGMA synchronous=OFF;
+            PRAGMA foreign_keys=OFF;
+            PRAGMA temp_store=MEMORY;
+            PRAGMA cache_size=-65536;
+        """)
+        try:
+            yield conn
+        finally:
+            conn.commit()
+            conn.executescript("".join(f"PRAGMA {p}={v};" for p, v in saved.items()))
+
+def clear_chunks(conn: sqlite3.Connection):
+    conn.execute("DELETE FROM chunk_vec")
+    conn.execute("DELETE FROM chunks")
+    conn.execute("INSERT INTO chunk_fts(chunk_fts) VALUES('delete-all')")
+
 def upsert_entry(conn: sqlite3.Connection, user_id: str, title: str, body: str, created_at: str, mood: str, tags: str) -> int:
     cur = conn.execute(
         "INSERT INTO entries(user_id,title,body,created_at,mood,tags) VALUES(?,?,?,?,?,?)",
@@ -74,9 +143,27 @@ def insert_chunk(conn: sqlite3.Connection, entry_id: int, user_id: str, idx: int
     conn.execute("INSERT INTO chunk_fts(rowid, text) VALUES(?,?)", (cid, text))
     return cid
 
+def insert_chunks_bulk(conn: sqlite3.Connection, rows: List[Tuple[int, str, int, str, str, Optional[str]]]) -> List[int]:
+    # rows: (entry_id, user_id, chunk_index, text, created_at, tags). Ids come from each
+    # insert's own lastrowid rather than being assumed contiguous.
+    if not rows:
+        return []
+    cur = conn.cursor()
+    ids = []
+    for row in rows:
+        cur.execute(
+            "INSERT INTO chunks(entry_id,user_id,chunk_index,text,created_at,tags) VALUES(?,?,?,?,?,?)",
+            row
+        )
+        ids.append(cur.lastrowid)
+    conn.executemany(
+        "INSERT INTO chunk_fts(rowid, text) VALUES(?,?)",
+        [(cid, row[3]) for cid, row in zip(ids, rows)]
+    )
+    return ids
+
 def embed_to_blob(vec: Iterable[float]) -> bytes:
-    arr = list(vec)
-    return struct.pack("<%sf" % len(arr), *arr)
+    return np.asarray(vec, dtype="<f4").tobytes()
 
 def store_embedding(conn: sqlite3.Connection, chunk_id: int, vec: List[float]):
     conn.execute(
@@ -84,45 +171,166 @@ def store_embedding(conn: sqlite3.Connection, chunk_id: int, vec: List[float]):
         (chunk_id, len(vec), embed_to_blob(vec))
     )
 
-def read_embedding(row) -> List[float]:
-    blob = row["embedding"]
-    dim = row["dim"]
-    floats = struct.unpack("<%sf" % dim, blob)
-    return list(floats)
+def store_embeddings_bulk(conn: sqlite3.Connection, items: Iterable[Tuple[int, Iterable[float]]], replace: bool = True):
+    # replace=False skips the conflict check when chunk_vec is known to be empty
+    verb = "INSERT OR REPLACE" if replace else "INSERT"
+    conn.executemany(
+        verb + " INTO chunk_vec(id, dim, embedding) VALUES(?,?,?)",
+        [(cid, len(vec), embed_to_blob(vec)) for cid, vec in items]
+    )
+
+def read_embedding(row) -> np.ndarray:
+    return np.frombuffer(row["embedding"], dtype="<f4", count=row["dim"])
 
 def get_candidate_chunks_by_keyword(conn: sqlite3.Connection, user_id: str, query: str, k: int = 20) -> List[Chunk]:
     conn.row_factory = sqlite3.Row
     cur = conn.execute("""
-        SELECT c.id, c.entry_id, c.text, c.created_at as date, c.tags
+        SELECT c.id, c.entry_id, c.text, c.created_at as date, c.tags, bm25(chunk_fts) as rank
         FROM chunk_fts
         JOIN chunks c ON c.id = chunk_fts.rowid
         WHERE chunk_fts MATCH ? AND c.user_id = ?
-        ORDER BY bm25(chunk_fts) LIMIT ?
+        ORDER BY rank LIMIT ?
     """, (query, user_id, k))
     out = []
     for r in cur.fetchall():
-        out.append(Chunk(id=r["id"], entry_id=r["entry_id"], text=r["text"], date=r["date"], tags=r["tags"]))
+        out.append(Chunk(id=r["id"], entry_id=r["entry_id"], text=r["text"], date=r["date"], tags=r["tags"], score=-r["rank"]))
     return out
 
-def get_embeddings_for_ids(conn: sqlite3.Connection, ids: Iterable[int]) -> List[Tuple[int, List[float], str]]:
+def get_embeddings_for_ids(conn: sqlite3.Connection, ids: Iterable[int]) -> List[Tuple[int, np.ndarray, str]]:
+    # Pass ids as one JSON array so the statement text (and its cached plan) is the same for any batch size
     conn.row_factory = sqlite3.Row
-    q = "SELECT v.id, v.dim, v.embedding, c.created_at as date FROM chunk_vec v JOIN chunks c ON c.id=v.id WHERE v.id IN (%s)" % ",".join("?"*len(list(ids)))
-    cur = conn.execute(q, tuple(ids))
+    cur = conn.execute("""
+        SELECT v.id, v.dim, v.embedding, c.created_at as date
+        FROM chunk_vec v JOIN chunks c ON c.id=v.id
+        WHERE v.id IN (SELECT value FROM json_each(?))
+    """, (json.dumps([int(i) for i in ids]),))
     res = []
     for r in cur.fetchall():
         vec = read_embedding(r)
         res.append((r["id"], vec, r["date"]))
     return res
 
-def all_embeddings_for_user(conn: sqlite3.Connection, user_id: str) -> List[Tuple[int, List[float], str, str]]:
+def all_embeddings_for_user(conn: sqlite3.Connection, user_id: str) -> Tuple[np.ndarray, np.ndarray, List[str], List[str]]:
+    # Returns (int64 ids, (N, dim) float32 matrix with unit-length rows, dates, texts).
+    # Only rows of the current embedding_dim are returned; others (left by an earlier
+    # embedding model) are skipped and logged until a /reindex re-embeds them.
+    dim = embedding_dim(conn, user_id)
     conn.row_factory = sqlite3.Row
     cur = conn.execute("""
-        SELECT v.id, v.dim, v.embedding, c.created_at as date, c.text
+        SELECT v.id, v.embedding, c.created_at as date, c.text
         FROM chunk_vec v JOIN chunks c ON c.id=v.id
-        WHERE c.user_id = ?
-    """, (user_id,))
-    out = []
-    for r in cur.fetchall():
-        vec = read_embedding(r)
-        out.append((r["id"], vec, r["date"], r["text"]))
-    return out
\ No newline at end of file
+        WHERE c.user_id = ? AND v.dim = ?
+    """, (user_id, dim))
+    rows = cur.fetchall()
+    skipped = count_embeddings_for_user(conn, user_id) - len(rows)
+    if skipped:
+        logger.warning(f"Skipping {skipped} embeddings for {user_id} whose dim != {dim}; run /reindex")
+    ids = [r["id"] for r in rows]
+    dates = [r["date"] for r in rows]
+    texts = [r["text"] for r in rows]
+    if not rows:
+        return np.empty(0, dtype=np.int64), np.empty((0, 0), dtype=np.float32), dates, texts
+    # Blobs are packed little-endian float32: one join + frombuffer, no per-row arrays
+    matrix = np.frombuffer(b"".join(r["embedding"] for r in rows), dtype="<f4").reshape(len(rows), dim)
+    matrix = matrix / (np.linalg.norm(matrix, axis=1, keepdims=True) + 1e-8)
+    return np.asarray(ids, dtype=np.int64), matrix.astype(np.float32, copy=False), dates, texts
+
+def count_embeddings_for_user(conn: sqlite3.Connection, user_id: str, dim: Optional[int] = None) -> int:
+    # With dim, counts only rows of that dimension (what the exported matrix holds)
+    if dim is None:
+        return conn.execute(
+            "SELECT COUNT(*) FROM chunk_vec v JOIN chunks c ON c.id=v.id WHERE c.user_id = ?", (user_id,)
+        ).fetchone()[0]
+    return conn.execute(
+        "SELECT COUNT(*) FROM chunk_vec v JOIN chunks c ON c.id=v.id WHERE c.user_id = ? AND v.dim = ?",
+        (user_id, dim)
+    ).fetchone()[0]
+
+def chunk_dates_texts(conn: sqlite3.Connection, ids: np.ndarray) -> Tuple[List[str], List[str]]:
+    # Dates and texts aligned with ids, without touching the embedding blobs
+    cur = conn.execute(
+        "SELECT id, created_at, text FROM chunks WHERE id IN (SELECT value FROM json_each(?))",
+        (json.dumps(ids.tolist()),)
+    )
+    by_id = {r[0]: (r[1], r[2]) for r in cur.fetchall()}
+    rows = [by_id.get(int(i), ("", "")) for i in ids]
+    return [r[0] for r in rows], [r[1] for r in rows]
+
+def embedding_dim(conn: sqlite3.Connection, user_id: str) -> int:
+    # Dim of the user's newest embedding, i.e. the current model's
+    row = conn.execute(
+        "SELECT v.dim FROM chunk_vec v JOIN chunks c ON c.id=v.id WHERE c.user_id = ? ORDER BY v.id DESC LIMIT 1",
+        (user_id,)
+    ).fetchone()
+    return row[0] if row else 0
+
+def embedding_matrix_paths(vec_dir: str, user_id: str) -> Tuple[str, str]:
+    slug = hashlib.blake2b(user_id.encode("utf-8"), digest_size=8).hexdigest()
+    return os.path.join(vec_dir, f"embeddings_{slug}.f32"), os.path.join(vec_dir, f"ids_{slug}.i64")
+
+def export_embedding_matrix(conn: sqlite3.Connection, user_id: str, vec_dir: str):
+    # Rewrite the user's normalized vectors and matching chunk ids from chunk_vec.
+    # chunk_vec stays the durable copy; these files are the memmapped hot path (see EmbStore).
+    emb_path, ids_path = embedding_matrix_paths(vec_dir, user_id)
+    ids, matrix, _, _ = all_embeddings_for_user(conn, user_id)
+    if len(ids) == 0:
+        for path in (emb_path, ids_path):
+            if os.path.exists(path):
+                os.remove(path)
+        return
+
+    Path(vec_dir).mkdir(parents=True, exist_ok=True)
+    np.ascontiguousarray(matrix, dtype="<f4").tofile(emb_path + ".tmp")
+    np.asarray(ids, dtype="<i8").tofile(ids_path + ".tmp")
+    os.replace(emb_path + ".tmp", emb_path)
+    os.replace(ids_path + ".tmp", ids_path)
+
+class EmbStore:
+    # Append-only vector file for one user: embeddings_<slug>.f32 holds unit-length row i at
+    # offset i*dim*4, ids_<slug>.i64 the matching chunk ids. The vector file is mmapped
+    # read-only and exposed as a zero-copy (N, dim) view; appends write to the end and remap.
+    # Sizes that don't match ids * dim (e.g. an interrupted append) read as empty so the
+    # caller re-exports.
+    def __init__(self, vec_dir: str, user_id: str, dim: int):
+        self.emb_path, self.ids_path = embedding_matrix_paths(vec_dir, user_id)
+        self.dim = dim
+        self.lock = threading.Lock()
+        self._map()
+
+    def _map(self):
+        self.ids = np.empty(0, dtype=np.int64)
+        self._mm = None
+        if not self.dim or not (os.path.exists(self.emb_path) and os.path.exists(self.ids_path)):
+            return
+        ids = np.fromfile(self.ids_path, dtype="<i8")
+        if len(ids) == 0 or os.path.getsize(self.emb_path) != len(ids) * self.dim * 4:
+            return
+        with open(self.emb_path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.ids = ids
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def matrix(self) -> np.ndarray:
+        # Views keep their mmap alive after a remap, so readers never see it unmapped
+        if self._mm is None:
+            return np.empty((0, self.dim), dtype=np.float32)
+        return np.frombuffer(self._mm, dtype="<f4").reshape(-1, self.dim)
+
+    def append(self, ids: List[int], vecs: List[List[float]]):
+        if not ids:
+            return
+        rows = np.asarray(vecs, dtype=np.float32).reshape(len(ids), -1)
+        rows /= np.linalg.norm(rows, axis=1, keepdims=True) + 1e-8
+        with self.lock:
+            if len(self) and rows.shape[1] != self.dim:
+                raise ValueError(f"embedding dim {rows.shape[1]} != store dim {self.dim}")
+            self.dim = rows.shape[1]
+            Path(self.emb_path).parent.mkdir(parents=True, exist_ok=True)
+            # Vectors first: a crash between the writes leaves a size mismatch, never ids without rows
+            with open(self.emb_path, "ab") as f:
+                f.write(rows.astype("<f4").tobytes())
+            with open(self.ids_path, "ab") as f:
+                f.write(np.asarray(ids, dtype="<i8").tobytes())
+            self._map()
@@ -1,17 +1,41 @@
 # sidecar/llm.py
+import threading
 from llama_cpp import Llama
-from typing import Dict, Iterable
+from typing import Dict, Iterable, List
+
+class SharedLlama:
+    # One Llama handle per GGUF file, shared by ChatLLM and Embedder. A llama.cpp context is
+    # not thread-safe, so every call on it holds lock; a reload swaps llm for all holders.
+    def __init__(self):
+        self.llm = None
+        self.embedding = False
+        self.lock = threading.Lock()
+
+_LLAMA_SINGLETON: Dict[str, SharedLlama] = {}
+_LOAD_LOCK = threading.Lock()
+
+def load_llama(model_path: str, ctx_tokens: int, gpu_layers: int, embedding: bool) -> SharedLlama:
+    # Each caller's ctx_tokens is honored. A second caller of the same file reloads the
+    # handle only if it needs more context, or embeddings from a chat-only handle.
+    with _LOAD_LOCK:
+        shared = _LLAMA_SINGLETON.setdefault(model_path, SharedLlama())
+    with shared.lock:
+        llm = shared.llm
+        if llm is None or llm.n_ctx() < ctx_tokens or (embedding and not shared.embedding):
+            shared.embedding = shared.embedding or embedding
+            shared.llm = Llama(
+                model_path=model_path,
+                n_ctx=max(ctx_tokens, llm.n_ctx() if llm is not None else 0),
+                n_gpu_layers=gpu_layers,
+                embedding=shared.embedding,
+                logits_all=False,
+                verbose=True
+            )
+    return shared
 
 class ChatLLM:
     def __init__(self, model_path: str, ctx_tokens: int = 8192, gpu_layers: int = 0, temperature: float = 0.7, top_p: float = 0.9):
-        self.llm = Llama(
-            model_path=model_path,
-            n_ctx=ctx_tokens,
-            n_gpu_layers=gpu_layers,
-            embedding=False,
-            logits_all=False,
-            verbose=True
-        )
+        self.shared = load_llama(model_path, ctx_tokens, gpu_layers, embedding=False)
         self.temperature = temperature
         self.top_p = top_p
 
@@ -20,31 +44,34 @@ class ChatLLM:
             {"role": "system", "content": system},
             {"role": "user", "content": user}
         ]
-        for chunk in self.llm.create_chat_completion(
-            messages=messages,
-            temperature=self.temperature,
-            top_p=self.top_p,
-            max_tokens=max_tokens,
-            stream=True
-        ):
-            # chunk shape may have 'choices'[0]['delta']['content'] or 'choices'[0]['text']
-            choice = chunk["choices"][0]
-            delta = choice.get("delta") or {}
-            token = delta.get("content") or choice.get("text") or ""
-            if token:
-                yield token
+        # The lock is held for the whole stream; closing the generator releases it
+        with self.shared.lock:
+            for chunk in self.shared.llm.create_chat_completion(
+                messages=messages,
+                temperature=self.temperature,
+                top_p=self.top_p,
+                max_tokens=max_tokens,
+                stream=True
+            ):
+                # chunk shape may have 'choices'[0]['delta']['content'] or 'choices'[0]['text']
+                choice = chunk["choices"][0]
+                delta = choice.get("delta") or {}
+                token = delta.get("content") or choice.get("text") or ""
+                if token:
+                    yield token
 
 class Embedder:
     def __init__(self, model_path: str, ctx_tokens: int = 2048, gpu_layers: int = 0):
-        self.llm = Llama(
-            model_path=model_path,
-            n_ctx=ctx_tokens,
-            n_gpu_layers=gpu_layers,
-            embedding=True,
-            verbose=True
-        )
+        self.shared = load_llama(model_path, ctx_tokens, gpu_layers, embedding=True)
 
     def embed(self, text: str) -> Iterable[float]:
         # Returns list[float]
-        out = self.llm.create_embedding(input=[text])
-        return out["data"][0]["embedding"]
\ No newline at end of file
+        with self.shared.lock:
+            out = self.shared.llm.create_embedding(input=[text])
+        return out["data"][0]["embedding"]
+
+    def embed_batch(self, texts: List[str]) -> List[List[float]]:
+        # One create_embedding call for the whole list
+        with self.shared.lock:
+            out = self.shared.llm.create_embedding(input=texts)
+        return [d["embedding"] for d in out["data"]]
\ No newline at end of file
@@ -1,11 +1,20 @@
 # sidecar/rag.py
 from dataclasses import dataclass
+from datetime import date
 from typing import List, Tuple
-import math
-import time
-import re
+from itertools import chain
+import threading
 import numpy as np
 
+from rag_numba import topk_cosine
+
+try:
+    import simsimd
+except ImportError:  # optional SIMD kernels; NumPy/BLAS fallback below
+    simsimd = None
+
+HAS_SIMSIMD = simsimd is not None
+
 @dataclass
 class Doc:
     id: int
@@ -13,67 +22,183 @@ class Doc:
     date: str
     score: float
 
+@dataclass
+class DocBatch:
+    # Ranked candidates as parallel columns; Doc objects are only built for what is returned
+    ids: np.ndarray     # int64
+    scores: np.ndarray  # float32
+    dates: List[str]
+    texts: List[str]
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+def quantize_int8(rows: np.ndarray) -> np.ndarray:
+    # Symmetric per-row int8 quantization (each row scaled by 127 / max|v|). Cosine is
+    # scale-invariant, so the scales aren't kept.
+    rows = np.atleast_2d(np.asarray(rows, dtype=np.float32))
+    scales = 127.0 / (np.abs(rows).max(axis=1) + 1e-12)
+    return np.rint(rows * scales[:, None]).astype(np.int8)
+
+class CorpusCache:
+    # One user's dense-search corpus: unit-length float32 rows in a buffer that grows
+    # geometrically, plus parallel ids/dates/texts. The initial matrix (e.g. a read-only
+    # memmap) is used in place until the first append copies it into a growable buffer.
+    # Appends are guarded by a lock; snapshot() views stay valid while rows are appended.
+    # With int8=True rows are held as per-row-scaled int8 (a quarter of the bandwidth)
+    # and scored with SimSIMD's int8 cosine kernel.
+    def __init__(self, ids: np.ndarray, matrix: np.ndarray, dates: List[str], texts: List[str], int8: bool = False):
+        self.size = len(ids)
+        self.dim = matrix.shape[1] if self.size else 0
+        self.dtype = np.int8 if int8 else np.float32
+        self._ids = np.asarray(ids, dtype=np.int64)
+        self._mat = None
+        if self.size and int8:
+            self._mat = quantize_int8(matrix)
+        elif self.size:
+            self._mat = np.asarray(matrix, dtype=np.float32)
+        self.dates = list(dates)
+        self.texts = list(texts)
+        self.lock = threading.Lock()
+
+    def append(self, ids: List[int], vecs: List[List[float]], dates: List[str], texts: List[str]):
+        if not ids:
+            return
+        rows = np.asarray(vecs, dtype=np.float32).reshape(len(ids), -1)
+        rows /= np.linalg.norm(rows, axis=1, keepdims=True) + 1e-8
+        if self.dtype == np.int8:
+            rows = quantize_int8(rows)
+        with self.lock:
+            need = self.size + len(ids)
+            if self._mat is None:
+                self.dim = rows.shape[1]
+                self._mat = np.empty((max(need, 64), self.dim), dtype=self.dtype)
+                self._ids = np.empty(len(self._mat), dtype=np.int64)
+            elif need > len(self._mat):
+                capacity = max(need, 2 * len(self._mat))
+                mat = np.empty((capacity, self.dim), dtype=self.dtype)
+                mat[:self.size] = self._mat[:self.size]
+                id_buf = np.empty(capacity, dtype=np.int64)
+                id_buf[:self.size] = self._ids[:self.size]
+                self._mat, self._ids = mat, id_buf
+            self._mat[self.size:need] = rows
+            self._ids[self.size:need] = ids
+            self.dates.extend(dates)
+            self.texts.extend(texts)
+            self.size = need
+
+    def snapshot(self) -> Tuple[np.ndarray, np.ndarray, List[str], List[str]]:
+        # (ids, matrix, dates, texts) columns for dense_search
+        with self.lock:
+            if self._mat is None:
+                return np.empty(0, dtype=np.int64), np.empty((0, 0), dtype=np.float32), [], []
+            return self._ids[:self.size], self._mat[:self.size], self.dates, self.texts
+
 def simple_chunks(text: str, target_chars: int = 2400, overlap: int = 200) -> List[str]:
     # Naive splitter by characters (MVP). Replace with token-aware later.
-    text = re.sub(r"\s+", " ", text).strip()
-    out, i = [], 0
-    while i < len(text):
-        end = min(len(text), i + target_chars)
-        out.append(text[i:end])
-        if end == len(text): break
-        i = max(0, end - overlap)
-    return out
-
-def cosine_sim(a: np.ndarray, b: np.ndarray) -> float:
-    denom = (np.linalg.norm(a) * np.linalg.norm(b)) + 1e-8
-    return float(np.dot(a, b) / denom)
-
-def dense_search(query_vec: List[float], corpus: List[Tuple[int, List[float], str, str]], top_k: int = 20) -> List[Doc]:
-    q = np.array(query_vec, dtype=np.float32)
-    scored = []
-    for cid, emb, date, text in corpus:
-        s = cosine_sim(q, np.array(emb, dtype=np.float32))
-        scored.append(Doc(id=cid, text=text, date=date, score=s))
-    scored.sort(key=lambda d: d.score, reverse=True)
-    return scored[:top_k]
-
-def reciprocal_rank_fusion(dense: List[Doc], sparse: List[Doc], k: int = 60, top_k: int = 12) -> List[Doc]:
-    # RRF: sum 1/(k + rank)
-    score_map = {}
-    for i, d in enumerate(dense):
-        score_map.setdefault(d.id, Doc(id=d.id, text=d.text, date=d.date, score=0.0)).score += 1.0 / (k + i + 1)
-    for i, d in enumerate(sparse):
-        score_map.setdefault(d.id, Doc(id=d.id, text=d.text, date=d.date, score=0.0)).score += 1.0 / (k + i + 1)
-    fused = list(score_map.values())
-    fused.sort(key=lambda x: x.score, reverse=True)
-    return fused[:top_k]
-
-def recency_boost(docs: List[Doc], now_ts: float, half_life_days: float = 30.0) -> List[Doc]:
-    # Expect date as ISO string, e.g., "2025-09-24T12:00:00Z" or "2025-09-24"
-    def to_ts(d: str) -> float:
-        try:
-            return time.mktime(time.strptime(d[:10], "%Y-%m-%d"))
-        except:
-            return now_ts
-    hl = half_life_days * 86400.0
-    out = []
-    for d in docs:
-        age = max(0.0, now_ts - to_ts(d.date))
-        boost = 0.5 ** (age / hl)
-        out.append(Doc(id=d.id, text=d.text, date=d.date, score=d.score * (0.85 + 0.15 * boost)))
-    out.sort(key=lambda x: x.score, reverse=True)
-    return out
-
-def build_prompt(question: str, ctx_docs: List[Doc]) -> str:
-    bullets = "\n\n".join(f"• [{d.date}] {d.text}" for d in ctx_docs)
-    sys = (
-        "You are a helpful AI assistant that can have natural conversations on any topic. "
-        "When relevant context from the user's journal entries is provided, you may reference it to give more personalized responses, "
-        "but you can also engage in normal conversation about any subject. "
-        "Be conversational, helpful, and engaging."
-    )
-    if ctx_docs:
-        user = f"Question: {question}\n\nRelevant journal context (if applicable):\n{bullets}"
+    # split()/join collapses whitespace in one C-level pass; chunk starts are known up front.
+    text = " ".join(text.split())
+    step = max(1, target_chars - overlap)
+    return [text[s:s + target_chars] for s in range(0, max(len(text) - overlap, 1), step)] if text else []
+
+def cosine_scores(q: np.ndarray, matrix: np.ndarray) -> np.ndarray:
+    # Cosine similarity of unit-length q against every (unit-length) row of matrix.
+    # An int8 matrix (CorpusCache(int8=True)) is scored against an int8-quantized q.
+    if matrix.dtype == np.int8:
+        q8 = quantize_int8(q)
+        return 1.0 - np.asarray(simsimd.cdist(q8, matrix, metric="cosine"), dtype=np.float32)[0]
+    if simsimd is not None:
+        return 1.0 - np.asarray(simsimd.cdist(q[None, :], matrix, metric="cosine"), dtype=np.float32)[0]
+    return matrix @ q
+
+def dense_search(q: np.ndarray, corpus_mat: np.ndarray, ids: np.ndarray, dates: List[str], texts: List[str],
+                 top_k: int = 20) -> DocBatch:
+    # corpus_mat rows are unit-length, so one GEMV against the normalized query gives cosine scores.
+    # Takes CorpusCache.snapshot() columns directly; nothing is converted per row.
+    if len(ids) == 0 or top_k <= 0:
+        return DocBatch(np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32), [], [])
+    if simsimd is None:
+        # Numba kernel (or its NumPy fallback) fuses scoring and top-k selection
+        top, top_scores = topk_cosine(corpus_mat, q, top_k)
     else:
-        user = f"Question: {question}"
-    return sys, user
\ No newline at end of file
+        q = np.asarray(q, dtype=np.float32)
+        q = q / (np.linalg.norm(q) + 1e-8)
+        scores = cosine_scores(q, corpus_mat)
+        k = min(top_k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        top_scores = scores[top]
+    return DocBatch(ids[top], np.asarray(top_scores, dtype=np.float32),
+                    [dates[i] for i in top], [texts[i] for i in top])
+
+_EPOCH = date(1970, 1, 1).toordinal()
+_NAT_DAYS = np.datetime64("NaT", "D").astype(np.int64)
+
+def to_day(d: str) -> int:
+    # Days since the epoch for an ISO date prefix; the NaT sentinel when unparseable
+    try:
+        return date.fromisoformat(d[:10]).toordinal() - _EPOCH
+    except (ValueError, TypeError):
+        return _NAT_DAYS
+
+def parse_days(dates: List[str]) -> np.ndarray:
+    # ISO dates ("2025-09-24T12:00:00Z" or "2025-09-24") -> datetime64[D]; unparseable -> NaT
+    try:
+        return np.array([d[:10] for d in dates], dtype="datetime64[D]")
+    except (ValueError, TypeError):
+        return np.fromiter((to_day(d) for d in dates), dtype=np.int64, count=len(dates)).view("datetime64[D]")
+
+def recency_factor(dates: List[str], now_ts: float, half_life_days: float = 30.0) -> np.ndarray:
+    # 0.85 + 0.15 * 2^(-age/half_life); ages in whole days against today, undated counts as fresh
+    days = parse_days(dates)
+    today = np.datetime64(int(now_ts), "s").astype("datetime64[D]")
+    ages = (today - days).astype(np.int64)
+    ages[np.isnat(days)] = 0
+    return 0.85 + 0.15 * np.exp2(-np.maximum(ages, 0) / half_life_days)
+
+def fused_rank(dense: DocBatch, sparse: List, now_ts: float, top_k: int = 12,
+               half_life_days: float = 30.0, k: int = 60) -> List[Doc]:
+    # Reciprocal rank fusion (sum of 1/(k + rank)) and recency_factor in one pass: index the
+    # candidate union once, score rrf * recency as arrays, and build Docs only for the top_k survivors.
+    # dense/sparse are in rank order; sparse may be db.Chunk rows (id/text/date).
+    row, ids, dates, texts, ranked_rows = {}, [], [], [], []
+    for ranked in (zip(dense.ids.tolist(), dense.dates, dense.texts), ((c.id, c.date, c.text) for c in sparse)):
+        rows = []
+        for cid, date_, text in ranked:
+            r = row.get(cid)
+            if r is None:
+                r = row[cid] = len(ids)
+                ids.append(cid)
+                dates.append(date_)
+                texts.append(text)
+            rows.append(r)
+        ranked_rows.append(rows)
+    n = len(ids)
+    if n == 0 or top_k <= 0:
+        return []
+    # RRF is a sparse vector add of 1/(k + rank) per list; ids are re-indexed to 0..n-1 above
+    all_rows = np.fromiter(chain.from_iterable(ranked_rows), dtype=np.int64, count=sum(map(len, ranked_rows)))
+    weights = np.concatenate([1.0 / (k + np.arange(1, len(rows) + 1)) for rows in ranked_rows])
+    rrf = np.bincount(all_rows, weights=weights, minlength=n)
+    final = rrf * recency_factor(dates, now_ts, half_life_days)
+    top_k = min(top_k, n)
+    top = np.argpartition(-final, top_k - 1)[:top_k]
+    top = top[np.argsort(-final[top], kind="stable")]
+    return [Doc(id=ids[i], text=texts[i], date=dates[i], score=float(final[i])) for i in top]
+
+_SYS = (
+    "You are a helpful AI assistant that can have natural conversations on any topic. "
+    "When relevant context from the user's journal entries is provided, you may reference it to give more personalized responses, "
+    "but you can also engage in normal conversation about any subject. "
+    "Be conversational, helpful, and engaging."
+)
+
+def build_prompt(question: str, ctx_docs: List[Doc]) -> Tuple[str, str]:
+    if not ctx_docs:
+        return _SYS, "Question: " + question
+    parts = ["Question: ", question, "\n\nRelevant journal context (if applicable):\n"]
+    for i, d in enumerate(ctx_docs):
+        if i:
+            parts.append("\n\n")
+        parts += ("• [", d.date, "] ", d.text)
+    return _SYS, "".join(parts)
\ No newline at end of file
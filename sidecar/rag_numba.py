@@ -0,0 +1,74 @@
+# sidecar/rag_numba.py
+# Brute-force cosine top-k compiled with Numba, for hosts without SimSIMD.
+# Falls back to NumPy (BLAS GEMV + argpartition) when numba isn't installed.
+from typing import Tuple
+import numpy as np
+
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+if njit is not None:
+    HAS_NUMBA = True
+
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _dot_scores(M, q):
+        # One row per thread chunk; the inner loop vectorizes to FMA over the dimension
+        n, d = M.shape
+        out = np.empty(n, dtype=np.float32)
+        for i in prange(n):
+            acc = np.float32(0.0)
+            for j in range(d):
+                acc += M[i, j] * q[j]
+            out[i] = acc
+        return out
+
+    @njit(cache=True)
+    def _select_topk(scores, k):
+        # Insertion into a k-slot buffer kept sorted descending; cheap for k << n
+        top_idx = np.full(k, -1, dtype=np.int64)
+        top_val = np.full(k, -np.inf, dtype=np.float32)
+        for i in range(scores.shape[0]):
+            s = scores[i]
+            if s <= top_val[k - 1]:
+                continue
+            j = k - 1
+            while j > 0 and top_val[j - 1] < s:
+                top_val[j] = top_val[j - 1]
+                top_idx[j] = top_idx[j - 1]
+                j -= 1
+            top_val[j] = s
+            top_idx[j] = i
+        return top_idx, top_val
+
+    def topk_cosine(M: np.ndarray, q: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        # (indices, scores) of the k unit-length rows of M most similar to q, best first
+        q = np.ascontiguousarray(q, dtype=np.float32)
+        if q.shape[0] != M.shape[1]:
+            # The kernel reads M.shape[1] elements of q without bounds checks
+            raise ValueError(f"query dim {q.shape[0]} does not match corpus dim {M.shape[1]}")
+        q = q / (np.linalg.norm(q) + 1e-8)
+        scores = _dot_scores(M, q)
+        return _select_topk(scores, min(k, len(scores)))
+else:
+    HAS_NUMBA = False
+
+    def topk_cosine(M: np.ndarray, q: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        q = np.asarray(q, dtype=np.float32)
+        if q.shape[0] != M.shape[1]:
+            raise ValueError(f"query dim {q.shape[0]} does not match corpus dim {M.shape[1]}")
+        q = q / (np.linalg.norm(q) + 1e-8)
+        scores = M @ q
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return top, scores[top]
+
+def warmup(dim: int = 8):
+    # Trigger (or load cached) JIT compilation before the first request. Numba specializes on
+    # writability, and the live corpus is a read-only mmap view, so compile both variants.
+    M = np.ones((4, dim), dtype=np.float32)
+    topk_cosine(M, np.ones(dim, dtype=np.float32), 2)
+    M.setflags(write=False)
+    topk_cosine(M, np.ones(dim, dtype=np.float32), 2)
@@ -1,5 +1,12 @@
 # sidecar/server.py
-import os, time, json
+import os, time
+import asyncio
+import threading
+import anyio
+import numpy as np
+from functools import lru_cache
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from fastapi import FastAPI, Response, Request
 from fastapi.responses import StreamingResponse, JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
@@ -8,10 +15,12 @@ from dotenv import load_dotenv
 from typing import List
 import logging
 import traceback
+import orjson
 
-from db import open_db, migrate, upsert_entry, insert_chunk, store_embedding, get_candidate_chunks_by_keyword, all_embeddings_for_user
+from db import open_db, migrate, transaction, committed_read, bulk_load, clear_chunks, upsert_entry, insert_chunk, insert_chunks_bulk, store_embedding, store_embeddings_bulk, get_candidate_chunks_by_keyword, chunk_dates_texts, count_embeddings_for_user, embedding_dim, export_embedding_matrix, EmbStore
 from llm import ChatLLM, Embedder
-from rag import simple_chunks, dense_search, reciprocal_rank_fusion, recency_boost, build_prompt
+from rag_numba import HAS_NUMBA, warmup as warmup_topk
+from rag import HAS_SIMSIMD, CorpusCache, simple_chunks, dense_search, fused_rank, build_prompt
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -27,6 +36,16 @@ GPU_LAYERS = int(os.getenv("GPU_LAYERS", "0"))
 TOP_P = float(os.getenv("TOP_P", "0.9"))
 TEMP = float(os.getenv("TEMP", "0.7"))
 MAX_TOKENS = int(os.getenv("MAX_TOKENS", "512"))
+EMBED_BATCH = int(os.getenv("EMBED_BATCH", "32"))
+# >1 embeds batches concurrently; only for thread-safe embedding backends (one llama.cpp
+# context is not), so the default keeps the sequential embed_batch path
+EMBED_THREADS = int(os.getenv("EMBED_THREADS", "1"))
+EMBED_INT8 = os.getenv("EMBED_INT8", "0") == "1"
+# Dense retrieval is skipped for queries of at most SPARSE_SHORT_TOKENS words, or when the
+# best keyword hit scores at least SPARSE_SHORTCUT (-bm25; unset = never by score)
+SPARSE_SHORT_TOKENS = int(os.getenv("SPARSE_SHORT_TOKENS", "2"))
+SPARSE_SHORTCUT = float(os.getenv("SPARSE_SHORTCUT", "inf"))
+VEC_DIR = os.getenv("VEC_DIR") or os.path.join(os.path.dirname(DB_PATH or "."), "vectors")
 
 app = FastAPI()
 
@@ -43,16 +62,33 @@ app.add_middleware(
 conn = None
 chat = None
 embedder = None
+corpora = {}  # user_id -> CorpusCache
+emb_stores = {}  # user_id -> EmbStore backing a loaded CorpusCache
+# Per-user lock held across corpus load/export and across ingest commit + append, so a
+# load can neither miss a committed chunk nor see one that is appended again afterwards
+_corpus_locks = {}
+_corpus_locks_guard = threading.Lock()
+
+def corpus_lock(user_id: str) -> threading.Lock:
+    with _corpus_locks_guard:
+        return _corpus_locks.setdefault(user_id, threading.Lock())
 
 @app.on_event("startup")
 async def startup_event():
-    global conn, chat, embedder
+    global conn, chat, embedder, EMBED_INT8
     try:
         logger.info("Starting up sidecar server...")
         conn = open_db(DB_PATH)
         migrate(conn)
         logger.info("Database initialized")
 
+        if EMBED_INT8 and not HAS_SIMSIMD:
+            logger.warning("EMBED_INT8 needs simsimd for int8 cosine; using float32 corpus")
+            EMBED_INT8 = False
+        if not HAS_SIMSIMD and HAS_NUMBA:
+            warmup_topk()
+            logger.info("Numba top-k kernel ready")
+
         logger.info(f"Loading chat model: {MODEL_CHAT}")
         chat = ChatLLM(MODEL_CHAT, ctx_tokens=CTX_TOKENS, gpu_layers=GPU_LAYERS, temperature=TEMP, top_p=TOP_P)
         logger.info("Chat model loaded")
@@ -99,30 +135,117 @@ class ChatReq(BaseModel):
 def health():
     return {"ok": True, "models_loaded": {"chat": chat is not None, "embedder": embedder is not None}}
 
+def insert_entry_chunks(entry_id: int, user_id: str, chunks: List[str], created_at: str, tags: str) -> List[int]:
+    # Insert one entry's chunks (+ FTS rows); caller owns the transaction
+    return insert_chunks_bulk(conn, [
+        (entry_id, user_id, i, ch, created_at, tags) for i, ch in enumerate(chunks)
+    ])
+
+def embed_chunks(cids: List[int], chunks: List[str]):
+    # Embed in windows of EMBED_BATCH texts; a failed window is logged and skipped.
+    # Returns (cid, vec) pairs for the chunks that were embedded (in completion order).
+    windows = [(cids[s:s + EMBED_BATCH], chunks[s:s + EMBED_BATCH]) for s in range(0, len(chunks), EMBED_BATCH)]
+    vecs = []
+    if EMBED_THREADS > 1 and len(windows) > 1:
+        with ThreadPoolExecutor(max_workers=min(EMBED_THREADS, len(windows))) as ex:
+            futs = {ex.submit(embedder.embed_batch, texts): batch_cids for batch_cids, texts in windows}
+            for fut in as_completed(futs):
+                try:
+                    vecs.extend(zip(futs[fut], fut.result()))
+                except Exception as embed_error:
+                    logger.error(f"Failed to embed chunks {futs[fut]}: {embed_error}")
+        return vecs
+    for batch_cids, texts in windows:
+        try:
+            vecs.extend(zip(batch_cids, embedder.embed_batch(texts)))
+        except Exception as embed_error:
+            logger.error(f"Failed to embed chunks {batch_cids}: {embed_error}")
+    return vecs
+
+def embed_entry(body: str):
+    # Chunk + embed one entry before any transaction is opened, so other writers don't wait
+    # on the model. Returns the chunks and (chunk position, vec) pairs.
+    chunks = simple_chunks(body, target_chars=2400, overlap=200)
+    # Only embed if embedder is available
+    vecs = embed_chunks(list(range(len(chunks))), chunks) if embedder else []
+    return chunks, vecs
+
+def index_entry(entry_id: int, user_id: str, created_at: str, tags: str, chunks: List[str], vecs):
+    # Write an embedded entry's chunks and vectors; caller owns the transaction.
+    # Returns the (ids, vecs, dates, texts) to append to the user's corpus.
+    cids = insert_entry_chunks(entry_id, user_id, chunks, created_at, tags)
+    rows = [(cids[pos], vec) for pos, vec in vecs]
+    store_embeddings_bulk(conn, rows)
+    return ([cid for cid, _ in rows], [vec for _, vec in rows],
+            [created_at] * len(rows), [chunks[pos] for pos, _ in vecs])
+
+@lru_cache(maxsize=512)
+def _embed_cached(text: str) -> np.ndarray:
+    # Converted to float32 once here; shared between callers, so read-only
+    vec = np.asarray(embedder.embed(text), dtype=np.float32)
+    vec.setflags(write=False)
+    return vec
+
+def embed_query(text: str) -> np.ndarray:
+    # Retries, stream reconnects and /search + /chat/stream pairs repeat the same question
+    return _embed_cached(text)
+
+def sparse_is_enough(query: str, sparse) -> bool:
+    # Short exact-match queries (names, tags) are already answered by FTS; skip embed + scan
+    return len(query.split()) <= SPARSE_SHORT_TOKENS or sparse[0].score >= SPARSE_SHORTCUT
+
+def user_corpus(user_id: str) -> CorpusCache:
+    # Loaded once per user from the mmapped EmbStore (re-exported if it lags chunk_vec),
+    # then kept current by appending newly embedded chunks to both
+    corpus = corpora.get(user_id)
+    if corpus is not None:
+        return corpus
+    with corpus_lock(user_id):
+        corpus = corpora.get(user_id)
+        if corpus is None:
+            with committed_read(conn):
+                dim = embedding_dim(conn, user_id)
+                store = EmbStore(VEC_DIR, user_id, dim)
+                if len(store) != count_embeddings_for_user(conn, user_id, dim):
+                    export_embedding_matrix(conn, user_id, VEC_DIR)
+                    store = EmbStore(VEC_DIR, user_id, dim)
+                ids, matrix = store.ids, store.matrix()
+                dates, texts = chunk_dates_texts(conn, ids)
+            emb_stores[user_id] = store
+            corpus = corpora[user_id] = CorpusCache(ids, matrix, dates, texts, int8=EMBED_INT8)
+    return corpus
+
+def append_to_corpus(user_id: str, new_rows):
+    # Caller holds corpus_lock(user_id) and has committed the rows. Only users whose corpus
+    # is already loaded need updating; others load fresh on first search. Failures never
+    # propagate: the rows are saved, so the corpus is dropped and reloaded from chunk_vec.
+    corpus = corpora.get(user_id)
+    if corpus is None:
+        return
+    try:
+        corpus.append(*new_rows)
+    except Exception as append_error:
+        logger.error(f"Failed to append to corpus for {user_id}, reloading on next search: {append_error}")
+        corpora.pop(user_id, None)
+        emb_stores.pop(user_id, None)
+        return
+    try:
+        emb_stores[user_id].append(new_rows[0], new_rows[1])
+    except Exception as store_error:
+        # The on-disk copy is rebuilt from chunk_vec on next load; the live corpus is current
+        logger.error(f"Failed to append to vector store for {user_id}: {store_error}")
+
 @app.post("/entries")
 def add_entry(e: EntryIn):
     try:
-        entry_id = upsert_entry(conn, e.user_id, e.title, e.body, e.created_at, e.mood, e.tags)
-
         # Chunk + embed immediately (MVP)
-        chunks = simple_chunks(e.body, target_chars=2400, overlap=200)
-        chunk_count = 0
-
-        for i, ch in enumerate(chunks):
-            cid = insert_chunk(conn, entry_id, e.user_id, i, ch, e.created_at, e.tags)
-
-            # Only embed if embedder is available
-            if embedder:
-                try:
-                    vec = embedder.embed(ch)
-                    store_embedding(conn, cid, vec)
-                except Exception as embed_error:
-                    logger.error(f"Failed to embed chunk {cid}: {embed_error}")
-
-            chunk_count += 1
-
-        conn.commit()
-        return {"entry_id": entry_id, "chunks": chunk_count}
+        chunks, vecs = embed_entry(e.body)
+        with corpus_lock(e.user_id):
+            with transaction(conn):
+                entry_id = upsert_entry(conn, e.user_id, e.title, e.body, e.created_at, e.mood, e.tags)
+                new_rows = index_entry(entry_id, e.user_id, e.created_at, e.tags, chunks, vecs)
+            append_to_corpus(e.user_id, new_rows)
+        return {"entry_id": entry_id, "chunks": len(chunks)}
     except Exception as e:
         logger.error(f"Error adding entry: {e}")
         logger.error(traceback.format_exc())
@@ -132,18 +255,64 @@ def add_entry(e: EntryIn):
 def embed_chunk(r: EmbedReq):
     try:
         # For updating an existing entry or one-off chunks
-        cid = insert_chunk(conn, r.entry_id, r.user_id, 0, r.text, r.created_at, r.tags)
-
-        if embedder:
-            vec = embedder.embed(r.text)
-            store_embedding(conn, cid, vec)
-
-        conn.commit()
+        vec = embedder.embed(r.text) if embedder else None
+        with corpus_lock(r.user_id):
+            with transaction(conn):
+                cid = insert_chunk(conn, r.entry_id, r.user_id, 0, r.text, r.created_at, r.tags)
+                if embedder:
+                    store_embedding(conn, cid, vec)
+            if embedder:
+                append_to_corpus(r.user_id, ([cid], [vec], [r.created_at], [r.text]))
         return {"chunk_id": cid}
     except Exception as e:
         logger.error(f"Error embedding chunk: {e}")
         return {"error": str(e)}, 500
 
+@app.post("/reindex")
+def reindex():
+    try:
+        # Full rebuild of chunks, FTS and embeddings from the entries table.
+        # Chunks from all entries are embedded together so every batch is full, and before
+        # the write lock is taken, so ingest and searches aren't stalled behind the model.
+        select_entries = "SELECT id, user_id, body, created_at, tags FROM entries"
+        with committed_read(conn):
+            rows = conn.execute(select_entries).fetchall()
+        prepared = [(row, simple_chunks(row[2], target_chars=2400, overlap=200)) for row in rows]
+        flat = [ch for _, chunks in prepared for ch in chunks]
+        vecs = dict(embed_chunks(list(range(len(flat))), flat)) if embedder else {}
+
+        with bulk_load(conn), transaction(conn):
+            # Entries added while embedding are few; embed them here rather than drop them
+            seen = {row[0] for row in rows}
+            late = [row for row in conn.execute(select_entries).fetchall() if row[0] not in seen]
+            if late:
+                late_prepared = [(row, simple_chunks(row[2], target_chars=2400, overlap=200)) for row in late]
+                late_flat = [ch for _, chunks in late_prepared for ch in chunks]
+                if embedder:
+                    vecs.update(embed_chunks(list(range(len(flat), len(flat) + len(late_flat))), late_flat))
+                prepared += late_prepared
+                rows += late
+
+            clear_chunks(conn)
+            stored, pos = [], 0
+            for (entry_id, user_id, _, created_at, tags), chunks in prepared:
+                cids = insert_entry_chunks(entry_id, user_id, chunks, created_at, tags)
+                stored.extend((cid, vecs[pos + i]) for i, cid in enumerate(cids) if pos + i in vecs)
+                pos += len(chunks)
+            store_embeddings_bulk(conn, stored, replace=False)
+
+        for user_id in {row[1] for row in rows} | set(corpora):
+            with corpus_lock(user_id):
+                with committed_read(conn):
+                    export_embedding_matrix(conn, user_id, VEC_DIR)
+                corpora.pop(user_id, None)
+                emb_stores.pop(user_id, None)
+        return {"entries": len(rows), "chunks": pos}
+    except Exception as e:
+        logger.error(f"Error reindexing: {e}")
+        logger.error(traceback.format_exc())
+        return {"error": str(e)}, 500
+
 @app.post("/search")
 def search(req: SearchReq):
     try:
@@ -152,16 +321,14 @@ def search(req: SearchReq):
         # Always do sparse/keyword search
         sparse = get_candidate_chunks_by_keyword(conn, req.user_id, req.query, k=max(20, req.k))
 
-        if embedder and sparse:
+        if embedder and sparse and not sparse_is_enough(req.query, sparse):
             # Dense search only if embedder is available and we have results
             try:
-                qvec = embedder.embed(req.query)
-                corpus = all_embeddings_for_user(conn, req.user_id)
-                dense = dense_search(qvec, corpus, top_k=max(20, req.k))
+                qvec = embed_query(req.query)
+                ids, mat, dates, texts = user_corpus(req.user_id).snapshot()
+                dense = dense_search(qvec, mat, ids, dates, texts, top_k=max(20, req.k))
                 # Fuse + recency boost
-                fused = reciprocal_rank_fusion(dense, sparse, top_k=req.k)
-                ranked = recency_boost(fused, now_ts=time.time(), half_life_days=30.0)
-                results = ranked
+                results = fused_rank(dense, sparse, now_ts=time.time(), top_k=req.k, half_life_days=30.0)
             except Exception as embed_error:
                 logger.error(f"Dense search failed, using sparse only: {embed_error}")
                 results = sparse[:req.k]
@@ -183,50 +350,90 @@ def search(req: SearchReq):
         logger.error(traceback.format_exc())
         return {"error": str(e)}, 500
 
-@app.post("/chat/stream")
-def chat_stream(req: ChatReq):
-    try:
-        # Retrieve context
-        ctx_docs = []
-
-        # Get sparse results as baseline
-        sparse = get_candidate_chunks_by_keyword(conn, req.user_id, req.question, k=max(20, req.k))
-
-        if embedder and sparse:
-            try:
-                qvec = embedder.embed(req.question)
-                corpus = all_embeddings_for_user(conn, req.user_id)
-                dense = dense_search(qvec, corpus, top_k=max(20, req.k))
-                fused = reciprocal_rank_fusion(dense, sparse, top_k=req.k)
-                ranked = recency_boost(fused, now_ts=time.time(), half_life_days=30.0)
-                ctx_docs = ranked
-            except Exception as embed_error:
-                logger.error(f"Context retrieval failed, using sparse: {embed_error}")
-                from rag import Doc
-                ctx_docs = [Doc(id=c.id, text=c.text, date=c.date, score=1.0) for c in sparse[:req.k]]
-        else:
-            # Fallback to sparse only
+def retrieve_context(req: ChatReq):
+    # Blocking (SQLite + embedding); run off the event loop
+    ctx_docs = []
+
+    # Get sparse results as baseline
+    sparse = get_candidate_chunks_by_keyword(conn, req.user_id, req.question, k=max(20, req.k))
+
+    if embedder and sparse and not sparse_is_enough(req.question, sparse):
+        try:
+            qvec = embed_query(req.question)
+            ids, mat, dates, texts = user_corpus(req.user_id).snapshot()
+            dense = dense_search(qvec, mat, ids, dates, texts, top_k=max(20, req.k))
+            ctx_docs = fused_rank(dense, sparse, now_ts=time.time(), top_k=req.k, half_life_days=30.0)
+        except Exception as embed_error:
+            logger.error(f"Context retrieval failed, using sparse: {embed_error}")
             from rag import Doc
             ctx_docs = [Doc(id=c.id, text=c.text, date=c.date, score=1.0) for c in sparse[:req.k]]
+    else:
+        # Fallback to sparse only
+        from rag import Doc
+        ctx_docs = [Doc(id=c.id, text=c.text, date=c.date, score=1.0) for c in sparse[:req.k]]
+    return ctx_docs
+
+# SSE framing, pre-encoded; tokens are escaped with one translate() instead of two replace()
+_DATA = b"data:"
+_NN = b"\n\n"
+_TRANS = str.maketrans({"\n": "\\n", "\r": "\\r"})
+
+def produce_tokens(sys: str, user: str, loop: asyncio.AbstractEventLoop, queue: asyncio.Queue, stop: threading.Event):
+    # Runs in a worker thread: feeds llama.cpp tokens to the event loop, then an exception or None
+    try:
+        # closing() releases the model lock in this thread as soon as we stop early
+        with closing(chat.stream_chat(sys, user, max_tokens=MAX_TOKENS)) as tokens:
+            for tok in tokens:
+                if stop.is_set():
+                    break
+                loop.call_soon_threadsafe(queue.put_nowait, tok)
+    except Exception as stream_error:
+        loop.call_soon_threadsafe(queue.put_nowait, stream_error)
+    finally:
+        loop.call_soon_threadsafe(queue.put_nowait, None)
 
+@app.post("/chat/stream")
+async def chat_stream(req: ChatReq):
+    try:
+        ctx_docs = await anyio.to_thread.run_sync(retrieve_context, req)
         sys, user = build_prompt(req.question, ctx_docs)
 
-        def gen():
+        async def gen():
+            loop = asyncio.get_running_loop()
+            queue = asyncio.Queue()
+            stop = threading.Event()  # set on client disconnect so the worker stops generating
+            producer = asyncio.create_task(anyio.to_thread.run_sync(produce_tokens, sys, user, loop, queue, stop))  # noqa: F841 (keep a reference)
             try:
                 # Server-Sent Events (SSE)
-                yield "event: sources\ndata:" + json.dumps([
+                yield b"event: sources\ndata:" + orjson.dumps([
                     {"id": d.id, "date": d.date, "preview": d.text[:200]} for d in ctx_docs
-                ]) + "\n\n"
-
-                for tok in chat.stream_chat(sys, user, max_tokens=MAX_TOKENS):
-                    # Escape newlines for SSE format
-                    escaped_tok = tok.replace("\n", "\\n").replace("\r", "\\r")
-                    yield "data:" + escaped_tok + "\n\n"
-
-                yield "event: done\ndata: [DONE]\n\n"
+                ]) + _NN
+
+                buf = bytearray()
+                done = False
+                while not done:
+                    # Block for one token, then coalesce any that queued meanwhile into one chunk
+                    tok = await queue.get()
+                    while True:
+                        if tok is None or isinstance(tok, Exception):
+                            done = True
+                            break
+                        buf += _DATA + tok.translate(_TRANS).encode("utf-8") + _NN
+                        if queue.empty():
+                            break
+                        tok = queue.get_nowait()
+                    if buf:
+                        yield bytes(buf)
+                        buf.clear()
+                if tok is not None:
+                    raise tok
+
+                yield b"event: done\ndata: [DONE]\n\n"
             except Exception as stream_error:
                 logger.error(f"Error in chat stream: {stream_error}")
-                yield "event: error\ndata:" + json.dumps({"error": str(stream_error)}) + "\n\n"
+                yield b"event: error\ndata:" + orjson.dumps({"error": str(stream_error)}) + _NN
+            finally:
+                stop.set()
 
         return StreamingResponse(gen(), media_type="text/event-stream")
 